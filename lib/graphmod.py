@@ -8,10 +8,9 @@
 #
 # This software may be used and distributed according to the terms of the
 # GNU General Public License version 2 or any later version.
+import bisect
 import time
 
-from datetime import datetime
-
 
 class Buffer(object):
     def __init__(self):
@@ -25,20 +24,26 @@ agescales = [("year", 3600 * 24 * 365), ("month", 3600 * 24 * 30),
              ("week", 3600 * 24 * 7), ("day", 3600 * 24), ("hour", 3600),
              ("minute", 60), ("second", 1)]
 
+# A scale is used once we're at least two of its units in the past; these are
+# the (ascending) deltas at which each scale, from smallest to largest, kicks
+# in.
+agethresholds = [s * 2 for t, s in reversed(agescales)]
+
+
+def plural(t, c):
+    if c == 1:
+        return t
+    return t + "s"
 
-def age(ts):
-    '''turn a timestamp into an age string.'''
 
-    def plural(t, c):
-        if c == 1:
-            return t
-        return t + "s"
+def fmt(t, c):
+    return "%d %s" % (c, plural(t, c))
 
-    def fmt(t, c):
-        return "%d %s" % (c, plural(t, c))
 
+def age(ts):
+    '''turn a timestamp (in seconds since the epoch) into an age string.'''
     now = time.time()
-    then = time.mktime(ts.timetuple()) + ts.microsecond / 1E6
+    then = ts
     if then > now:
         return 'in the future'
 
@@ -46,10 +51,9 @@ def age(ts):
     if delta > agescales[0][1] * 2:
         return time.strftime('%Y-%m-%d', time.gmtime(float(ts)))
 
-    for t, s in agescales:
-        n = delta // s
-        if n >= 2 or s == 1:
-            return '%s ago' % fmt(t, n)
+    i = max(0, bisect.bisect_right(agethresholds, delta) - 1)
+    t, s = agescales[-1 - i]
+    return '%s ago' % fmt(t, delta // s)
 
 
 def asciiedges(seen, rev, parents):
@@ -118,7 +122,17 @@ def fix_long_right_edges(edges):
 
 
 def ascii(buf, state, type, char, text, coldata):
-    """prints an ASCII graph of the DAG
+    """prints an ASCII graph of the DAG (see asciilines())"""
+    lines, indentation_level = asciilines(state, char, text, coldata)
+
+    # print lines
+    for (line, logstr) in zip(lines, text):
+        ln = "%-*s %s" % (2 * indentation_level, "".join(line), logstr)
+        buf.write(ln.rstrip() + '\n')
+
+
+def asciilines(state, char, text, coldata):
+    """computes the lines of an ASCII graph of the DAG
     takes the following arguments (one call per node in the graph):
       - Somewhere to keep the needed state in (init to asciistate())
       - Column of the current node in the set of ongoing edges.
@@ -133,6 +147,8 @@ def ascii(buf, state, type, char, text, coldata):
         in the next revision and the number of columns (ongoing edges)
         in the current revision. That is: -1 means one column removed;
         0 means no columns added or removed; 1 means one column added.
+    returns the graph lines (padded to match text, which is padded to match
+    them) and the indentation level at which text starts.
     """
 
     idx, edges, ncols, coldiff = coldata
@@ -207,34 +223,67 @@ def ascii(buf, state, type, char, text, coldata):
         while len(lines) < len(text):
             lines.append(extra_interline)
 
-    # print lines
-    indentation_level = max(ncols, ncols + coldiff)
-    for (line, logstr) in zip(lines, text):
-        ln = "%-*s %s" % (2 * indentation_level, "".join(line), logstr)
-        buf.write(ln.rstrip() + '\n')
-
     # ... and start over
     state[0] = coldiff
     state[1] = idx
 
+    return lines, max(ncols, ncols + coldiff)
+
 
 def generate(dag, current):
+    return label(layout(dag), current)[0]
+
+
+def layout(dag):
+    """lays out the graph of the DAG without drawing the nodes themselves.
+
+    the layout only depends on the shape of the DAG, so it can be reused
+    until a node is added. returns one (node, column, width, nodeline, rest)
+    entry per node, where nodeline is the graph line holding the node's
+    character (at 2 * column), which is followed by its label at width, and
+    rest holds the finished lines that follow it (see label()).
+    """
     seen, state = [], [0, 0]
+    rows = []
+    for node, parents in dag:
+        coldata = asciiedges(seen, node.idx, parents)
+        text = ['']
+        lines, indentation_level = asciilines(state, 'o', text, coldata)
+        width = 2 * indentation_level
+
+        buf = Buffer()
+        for (line, logstr) in zip(lines[1:], text[1:]):
+            ln = "%-*s %s" % (width, "".join(line), logstr)
+            buf.write(ln.rstrip() + '\n')
+
+        rows.append((node, coldata[0], width, "".join(lines[0]), buf.b))
+    return rows
+
+
+def label(rows, current):
+    """draws the nodes of a layout() and labels them with their ages.
+
+    returns the graph and the offset of the current node's character in it
+    (or None, if current isn't in the graph).
+    """
     buf = Buffer()
-    for node, parents in list(dag):
+    pos = None
+    for node, col, width, nodeline, rest in rows:
         if node.parent is not None:
-            tm = datetime.strptime(node.timestamp, '%d-%m-%Y %H-%M-%S')
-            age_label = age(tm)
+            age_label = age(node.timestamp)
         else:
             age_label = 'Root'
 
         if node.idx == current:
             char = '@'
             line = '[%s] %s' % (node.idx, age_label)
+            pos = len(buf.b) + 2 * col
         else:
             char = 'o'
             line = '%s %s' % (node.idx, age_label)
 
-        ascii(buf, state, 'C', char, [line],
-              asciiedges(seen, node.idx, parents))
-    return buf.b
+        nodeline = nodeline[:2 * col] + char + nodeline[2 * col + 1:]
+        ln = "%-*s %s" % (width, nodeline, line)
+        buf.write(ln.rstrip() + '\n')
+        buf.write(rest)
+    return buf.b, pos
@@ -4,9 +4,11 @@ This module contains the implementation of a simple N-ary tree, with each node
 containing a patch that takes us from one buffer state to another.
 """
 import collections
-import datetime
+import pickle
+import time
+import zlib
 
-from .diff_match_patch import diff_match_patch
+from .diff_match_patch import diff_match_patch, patch_obj
 
 
 class Node:
@@ -15,9 +17,12 @@ class Node:
     Args:
         idx (int): The Node's ID.
         parent (Node|None): The previous node on the current branch, if any.
-        timestamp (str): The creation date.
+        timestamp (int): The creation time, in seconds since the epoch.
         pos (int): The cursor position at the time of creation.
     """
+    __slots__ = ('idx', 'parent', 'timestamp', 'children', 'patches',
+                 'position')
+
     def __init__(self, idx, parent, timestamp, pos=None):
         self.idx = idx
         self.parent = parent
@@ -49,10 +54,27 @@ class UndoTree:
         self._buf = None
         self._dmp = diff_match_patch()
         self._index = collections.OrderedDict()
+        self._blobs = {}
 
     def __len__(self):
         return self._total
 
+    def __getstate__(self):
+        """Leave out the state that we can rebuild on load.
+        """
+        state = self.__dict__.copy()
+        del state['_dmp']
+        del state['_blobs']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._dmp = diff_match_patch()
+        self._blobs = {}
+        for node in self._index.values():
+            for blob in node.patches.values():
+                self._blobs[blob] = blob
+
     def insert(self, buf, pos=None):
         """Insert the given buffer and (optional) position into the tree.
 
@@ -60,9 +82,11 @@ class UndoTree:
             buf (str): The contents to be inserted.
             pos (None|int): An optional integer representing a buffer position.
         """
+        if buf == self._buf:
+            return  # `buf` is already the active state; skip the diff.
+
         self._total = self._total + 1
-        tm = datetime.datetime.now().strftime('%d-%m-%Y %H-%M-%S')
-        to_add = Node(self._total, None, tm, pos)
+        to_add = Node(self._total, None, int(time.time()), pos)
 
         if self._root is None:
             self._root = to_add
@@ -73,29 +97,36 @@ class UndoTree:
 
             parent = self._find_parent()
             to_add.parent = parent
-            to_add.patches[parent.idx] = patches[1]
+            to_add.patches[parent.idx] = self._pack(patches[1])
 
             parent.children.append(to_add)
-            parent.patches[self._total] = patches[0]
+            parent.patches[self._total] = self._pack(patches[0])
 
         self._n_idx = to_add.idx
         self._buf = buf
         self.b_idx = 0
         self._index[self._total] = to_add
 
-    def undo(self):
+    def undo(self, compute_diff=True):
         """Move backward one node, if possible.
+
+        Args:
+            compute_diff (bool): `False` if the caller doesn't need the text
+                of the applied patch (it's then returned as `None`).
         """
         diff = None
         pos = None
         parent = self.head().parent
         if parent is not None:
-            self._buf, diff = self._apply_patch(parent.idx)
+            self._buf, diff = self._apply_patch(parent.idx, compute_diff)
             pos = parent.position
         return self._buf, diff, pos
 
-    def redo(self):
+    def redo(self, compute_diff=True):
         """Move forward one node, if possible.
+
+        Args:
+            compute_diff (bool): See `undo`.
         """
         diff = None
         pos = None
@@ -110,7 +141,7 @@ class UndoTree:
         else:
             return self._buf, diff, pos
 
-        self._buf, diff = self._apply_patch(target.idx)
+        self._buf, diff = self._apply_patch(target.idx, compute_diff)
         pos = target.position
 
         return self._buf, diff, pos
@@ -135,6 +166,12 @@ class UndoTree:
         """
         return self._search(self._n_idx)
 
+    def diff(self, src, dst):
+        """Return the text of the patch from node `src` to its neighbour `dst`.
+        """
+        patch = self._unpack(self._search(src).patches[dst])
+        return self._dmp.patch_toText(patch)
+
     def switch_branch(self, direction):
         """Switch to the next branch in `direction`.
         """
@@ -177,24 +214,73 @@ class UndoTree:
             return []
 
         p1 = self._dmp.patch_make(s1, d1)
+        p2 = self._invert_patch(p1)
+        if p2 is None:
+            p2 = self._dmp.patch_make(s2, [(-op, text) for op, text in d1])
+        return [p1, p2]
 
-        # Instead of diffing twice, we just flip the first.
-        for i in range(len(d1)):
-            le = list(d1[i])
-            le[0] = le[0] * -1
-            d1[i] = le
+    def _invert_patch(self, patches):
+        """Create the patch that undoes `patches`, if possible.
 
-        p2 = self._dmp.patch_make(s2, d1)
-        return [p1, p2]
+        Instead of calling `patch_make` twice, we just flip the operations and
+        lengths of the first. `patch_make` positions each patch relative to the
+        text with all previous patches applied, so the start points have to be
+        shifted back by the growth of the earlier patches.
 
-    def _apply_patch(self, idx):
+        This only works when no two patches overlap: otherwise, a patch's
+        context was taken from text that a neighbouring patch changes, so we
+        return `None` and let the caller build the inverse from scratch.
+        """
+        inverted = []
+        delta = 0
+        end = 0
+        for patch in patches:
+            if patch.start2 < end:
+                return None
+            end = patch.start2 + patch.length2
+            p = patch_obj()
+            p.diffs = [(-op, text) for op, text in patch.diffs]
+            p.start1 = p.start2 = patch.start2 - delta
+            p.length1, p.length2 = patch.length2, patch.length1
+            delta += patch.length2 - patch.length1
+            inverted.append(p)
+        return inverted
+
+    def _apply_patch(self, idx, compute_diff=True):
         """Apply the node's patch given by `idx`.
 
         Returns:
-            (str, str): The resulting text and the patch itself.
+            (str, str|None): The resulting text and the patch itself (or
+            `None` if `compute_diff` is `False`).
         """
-        patch = self.head().patches[idx]
+        patch = self._unpack(self.head().patches[idx])
         out = self._dmp.patch_apply(patch, self._buf)
         self._n_idx = idx
-        text = self._dmp.patch_toText(patch)
+        text = self._dmp.patch_toText(patch) if compute_diff else None
         return out[0], text
+
+    def _pack(self, patches):
+        """Compress `patches` for storage in a Node.
+
+        Patches are only needed when we move to a neighbouring node, so we
+        store them as a compact blob rather than as `patch_obj`s. Repeated
+        edits (e.g., toggling the same text back and forth) produce identical
+        blobs, so we only keep one copy of each.
+        """
+        data = [(p.diffs, p.start1, p.start2, p.length1, p.length2)
+                for p in patches]
+        blob = zlib.compress(pickle.dumps(data, pickle.HIGHEST_PROTOCOL), 1)
+        return self._blobs.setdefault(blob, blob)
+
+    def _unpack(self, blob):
+        """Restore the patches compressed by `_pack`.
+        """
+        patches = []
+        for diffs, start1, start2, length1, length2 in pickle.loads(
+                zlib.decompress(blob)):
+            p = patch_obj()
+            p.diffs = diffs
+            p.start1, p.start2 = start1, start2
+            p.length1, p.length2 = length1, length2
+            patches.append(p)
+        return patches
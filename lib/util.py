@@ -6,40 +6,145 @@ NOTE: `calc_width`, `get_group` and `set_active_group` were borrowed from
 https://github.com/aziz/SublimeFileBrowser.
 """
 import hashlib
+import itertools
 import pickle
 import os
+import threading
+import time
+import weakref
+import zlib
 
 import sublime
 
 from . import graphmod
 from . import tree
+from .diff_match_patch import diff_match_patch
 
 SETTING_FILE = 'Sublundo.sublime-settings'
 ST_VERSION = int(sublime.version())
 
-# `CHANGE_INDEX` maps view IDs to their `change_count()`s. We use this to
-# determine when to insert into the view's UndoTree.
-CHANGE_INDEX = {}
-
-# `VIEW_TO_TREE` maps view IDs to their UndoTrees.
+# `VIEW_TO_TREE` maps view IDs to their state: the view's UndoTree ('tree'),
+# its session file ('loc'), and the `change_count()` at which we last
+# inserted into the tree ('changes'), which tells us when to insert again.
 VIEW_TO_TREE = {}
 
 # `VIS_TO_VIEW` maps visualization view IDs to their actual views.
 VIS_TO_VIEW = {}
 
+# `VIS_TO_BUFFER` maps visualization view IDs to the rendering they show.
+VIS_TO_BUFFER = {}
+
+DMP = diff_match_patch()
+
+# `PENDING_STEPS` maps visualization view IDs to the moves (direction and
+# count) queued up by `sublundo_next_node`.
+PENDING_STEPS = {}
+
+# `HIGHLIGHTED_VIEWS` holds the IDs of views that we've added 'sublundo'
+# regions to.
+HIGHLIGHTED_VIEWS = set()
+
+# `DIFF_PANELS` maps window IDs to their diff output panels.
+DIFF_PANELS = {}
+
+# `PENDING_INSERTS` maps view IDs to the token of their most recently
+# scheduled (debounced) insert; see `schedule_insert`.
+PENDING_INSERTS = {}
+INSERT_TOKENS = itertools.count()
+
+# `DEBUG` caches the 'debug' setting, which is checked on every call to
+# `debug()`. It's kept up-to-date by `reload_settings`.
+DEBUG = False
+
+# `SETTINGS_CACHE` maps setting names to their values, as read by
+# `get_setting`. It's cleared by `reload_settings`.
+SETTINGS_CACHE = {}
+
+# `HISTORY_DIR` is where we store *.sublundo-session files. It's computed by
+# `history_dir` on first use, since the API isn't available at import time.
+HISTORY_DIR = None
+
+# `SESSION_CACHE` maps file paths to their *.sublundo-session files.
+SESSION_CACHE = {}
+
+# `RENDER_CACHE` maps UndoTrees to their most recent rendering and the state
+# it was rendered from.
+RENDER_CACHE = weakref.WeakKeyDictionary()
+
+# `LAYOUT_CACHE` maps UndoTrees to their `graphmod.layout` and the tree size
+# it was computed at.
+LAYOUT_CACHE = weakref.WeakKeyDictionary()
+
+# `PENDING_SAVES` maps session paths to the most recently pickled UndoTree
+# that hasn't been written to disk yet.
+PENDING_SAVES = {}
+
+# `SESSION_LOCKS` maps session paths to the locks that serialize their writes
+# (which can come from both the async thread and `plugin_unloaded`) and loads.
+# They're per-path so that loading one session never waits on another's write.
+SESSION_LOCKS = {}
+
 
 def save_session(session, path):
     """Save the given UndoTree.
+
+    The tree is pickled (and compressed) on the calling thread, so later edits
+    can't race with the pickler, but the file is written on Sublime Text's
+    async thread.
+    Consecutive saves of the same path collapse into a single write.
+    """
+    PENDING_SAVES[path] = dump_session(session)
+    sublime.set_timeout_async(lambda: write_session(path), 0)
+
+
+def dump_session(session):
+    """Return the given UndoTree as a compressed pickle.
     """
-    with open(path, 'wb') as loc:
-        pickle.dump(session, loc, pickle.HIGHEST_PROTOCOL)
+    blob = pickle.dumps(session, pickle.HIGHEST_PROTOCOL)
+    return zlib.compress(blob, 1)
+
+
+def session_lock(path):
+    """Return the lock for the session stored on `path`.
+    """
+    # `setdefault` is atomic, so two threads can't end up with different locks.
+    return SESSION_LOCKS.setdefault(path, threading.Lock())
+
+
+def write_session(path):
+    """Write the pending session for `path`, if any, to disk.
+
+    We write to a temporary file first so that an interrupted write can't
+    leave a truncated session behind.
+    """
+    with session_lock(path):
+        blob = PENDING_SAVES.pop(path, None)
+        if blob is None:
+            return  # A previous call already wrote the latest snapshot.
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as loc:
+            loc.write(blob)
+        os.replace(tmp, path)
+
+
+def write_sessions(sessions=()):
+    """Save the given (UndoTree, path) pairs and write all pending sessions.
+
+    Unlike `save_session`, this pickles the trees on the calling thread, so
+    the trees must no longer be changing.
+    """
+    for session, path in sessions:
+        PENDING_SAVES[path] = dump_session(session)
+    for path in list(PENDING_SAVES):
+        write_session(path)
 
 
 def load_session(path, buf):
     """Try to load the UndoTree stored on `path`.
 
     If the current buffer (given by `buf`) doesn't match the last state stored
-    on disk, we return a new UndoTree.
+    on disk, we return a new UndoTree. A session that's still waiting to be
+    written takes precedence over the one on disk.
 
     Args:
         path (str): The path to the *.sublundo-session file.
@@ -48,13 +153,19 @@ def load_session(path, buf):
     Returns:
         tree.UndoTree
     """
-    if os.path.exists(path):
-        try:
+    with session_lock(path):
+        blob = PENDING_SAVES.get(path)
+        if blob is None and os.path.exists(path):
             with open(path, 'rb') as loc:
-                canidate = pickle.load(loc)
+                blob = loc.read()
+    if blob is not None:
+        try:
+            canidate = pickle.loads(zlib.decompress(blob))
             if canidate.text() == buf:
                 return canidate, True
-        except EOFError:
+        except (EOFError, AttributeError, pickle.UnpicklingError, zlib.error):
+            # The session is either truncated or was written by an
+            # incompatible version of Sublundo.
             pass
     return tree.UndoTree(), False
 
@@ -124,8 +235,12 @@ def set_active_group(window, view, other_group):
 def get_setting(name, default=''):
     """Return the value associated with the setting `name`.
     """
-    settings = sublime.load_settings(SETTING_FILE)
-    return settings.get(name, default)
+    try:
+        value = SETTINGS_CACHE[name]
+    except KeyError:
+        value = sublime.load_settings(SETTING_FILE).get(name)
+        SETTINGS_CACHE[name] = value
+    return default if value is None else value
 
 
 def set_setting(name, value):
@@ -134,6 +249,24 @@ def set_setting(name, value):
     settings = sublime.load_settings(SETTING_FILE)
     settings.set(name, value)
     sublime.save_settings(SETTING_FILE)
+    SETTINGS_CACHE.pop(name, None)
+
+
+def watch_settings():
+    """Cache our settings and refresh them whenever they're changed.
+    """
+    settings = sublime.load_settings(SETTING_FILE)
+    settings.clear_on_change('sublundo')
+    settings.add_on_change('sublundo', reload_settings)
+    reload_settings()
+
+
+def reload_settings():
+    """Refresh our cached settings.
+    """
+    global DEBUG
+    SETTINGS_CACHE.clear()
+    DEBUG = get_setting('debug', False)
 
 
 def debug(message, prefix='Sublundo', level='debug'):
@@ -147,7 +280,7 @@ def debug(message, prefix='Sublundo', level='debug'):
     Returns:
         str: Issue a standard console print command.
     """
-    if get_setting('debug'):
+    if DEBUG:
         print('{prefix}: [{level}] {message}'.format(message=message,
                                                      prefix=prefix,
                                                      level=level))
@@ -158,17 +291,60 @@ def walk_nodes(nodes):
     """
     for node in nodes:
         if node.parent is not None:
-            yield (node, [node.parent.idx])
+            yield (node, (node.parent.idx,))
         else:
-            yield (node, [])
+            yield (node, ())
 
 
 def render(tree):
     """Show an ASCII-formatted version of the given UndoTree.
+
+    Returns:
+        (str, int|None): The rendered tree and the offset of its active node.
+
+    The output only depends on the tree's shape (which changes on every
+    insert, and therefore with `len(tree)`), the active node, and -- through
+    the node ages -- the current second, so we re-use the last rendering when
+    none of those have changed.
     """
     current = tree.head().idx
-    nodes = reversed(tree.nodes())
-    return graphmod.generate(walk_nodes(nodes), current).rstrip()
+    key = (len(tree), current, int(time.time()))
+
+    cached = RENDER_CACHE.get(tree)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    buf, pos = graphmod.label(layout(tree), current)
+    RENDER_CACHE[tree] = (key, (buf.rstrip(), pos))
+    return RENDER_CACHE[tree][1]
+
+
+def changed_region(old, new):
+    """Find the part of `old` that needs to be replaced to turn it into `new`.
+
+    Returns:
+        (sublime.Region, str): The region of `old` and its replacement.
+    """
+    prefix = DMP.diff_commonPrefix(old, new)
+    suffix = DMP.diff_commonSuffix(old[prefix:], new[prefix:])
+    region = sublime.Region(prefix, len(old) - suffix)
+    return region, new[prefix:len(new) - suffix]
+
+
+def layout(tree):
+    """Return the `graphmod.layout` of the given UndoTree.
+
+    Moving around the tree only changes which node is marked as active (and
+    the node ages), so we lay the graph out once per tree size and only
+    re-label it on each render.
+    """
+    size = len(tree)
+    cached = LAYOUT_CACHE.get(tree)
+    if cached is None or cached[0] != size:
+        nodes = reversed(tree.nodes())
+        cached = (size, graphmod.layout(walk_nodes(nodes)))
+        LAYOUT_CACHE[tree] = cached
+    return cached[1]
 
 
 def buffer(view):
@@ -182,9 +358,74 @@ def make_session(path):
 
     TODO: What if a file is re-named? Currently, it's history would be lost.
     """
-    history = os.path.join(sublime.packages_path(), 'User', 'Sublundo')
-    m = hashlib.md5(path.encode())
-    return os.path.join(history, m.hexdigest() + '.sublundo-session')
+    loc = SESSION_CACHE.get(path)
+    if loc is None:
+        m = hashlib.md5(path.encode())
+        loc = os.path.join(history_dir(), m.hexdigest() + '.sublundo-session')
+        SESSION_CACHE[path] = loc
+    return loc
+
+
+def history_dir():
+    """Return the directory in which we store our sessions.
+    """
+    global HISTORY_DIR
+    if HISTORY_DIR is None:
+        HISTORY_DIR = os.path.join(sublime.packages_path(), 'User', 'Sublundo')
+    return HISTORY_DIR
+
+
+def schedule_insert(view):
+    """Insert the view's buffer into its UndoTree once typing settles down.
+
+    Every call within `insert_debounce_ms` of the previous one pushes the
+    insert back, so a burst of edits results in a single snapshot.
+    """
+    delay = get_setting('insert_debounce_ms', 300)
+    if delay <= 0:
+        insert_buffer(view)
+        return
+
+    token = next(INSERT_TOKENS)
+    PENDING_INSERTS[view.id()] = token
+
+    def flush():
+        if PENDING_INSERTS.get(view.id()) == token and view.is_valid():
+            insert_buffer(view)
+
+    sublime.set_timeout(flush, delay)
+
+
+def insert_buffer(view):
+    """Insert the view's buffer into its UndoTree, if it has changed.
+
+    This also cancels any pending insert scheduled by `schedule_insert`.
+    """
+    PENDING_INSERTS.pop(view.id(), None)
+    info = VIEW_TO_TREE.get(view.id())
+    if info is not None and info['changes'] != view.change_count():
+        info['tree'].insert(buffer(view), view.sel()[0].a)
+        info['changes'] = view.change_count()
+
+
+def diff_panel(window):
+    """Return the given window's diff output panel, if it has one.
+    """
+    panel = DIFF_PANELS.get(window.id())
+    if panel is None or not panel.is_valid():
+        panel = window.find_output_panel('sublundo')
+        if panel:
+            DIFF_PANELS[window.id()] = panel
+    return panel
+
+
+def find_visualization(view):
+    """Return the ID of the given view's open visualization, if any.
+    """
+    for vid, v in VIS_TO_VIEW.items():
+        if v.id() == view.id() and sublime.View(vid).is_valid():
+            return vid
+    return None
 
 
 def check_view(view):
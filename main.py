@@ -16,14 +16,19 @@ the plugin follows   :
 We also implement a `sublundo_visualize` command, which presents a Gundo-like
 visualization of the underlying UndoTree.
 """
+import glob
 import os
-from datetime import datetime, timedelta
+import threading
+import time
 
 import sublime
 import sublime_plugin
 
 from .lib import util
 
+# The built-in commands that we replace with `sublundo`.
+UNDO_COMMANDS = frozenset(('undo', 'redo_or_repeat', 'redo'))
+
 
 class SublundoOpenFileCommand(sublime_plugin.ApplicationCommand):
     """This is a wrapper class for SublimeText's `open_file` command.
@@ -76,14 +81,38 @@ class SublundoNextNodeCommand(sublime_plugin.TextCommand):
         # the `sublundo_visualize` command that we want a re-draw (vs. a new
         # draw).
         output = sublime.active_window().active_view().id()
+
+        # Holding a key down sends us a stream of moves; rather than updating
+        # the buffer and re-drawing the tree for each of them, we queue them
+        # up and apply them all at once. Moves in opposite directions don't
+        # necessarily cancel out (e.g., <undo><redo> may switch branches),
+        # so a change of direction flushes the queue first.
+        direction, count = util.PENDING_STEPS.get(output, (forward, 0))
+        if count and direction != forward:
+            SublundoNextNodeCommand.flush(output)
+            count = 0
+
+        util.PENDING_STEPS[output] = (forward, count + 1)
+        if not count:
+            sublime.set_timeout(
+                lambda: SublundoNextNodeCommand.flush(output), 15)
+
+    @staticmethod
+    def flush(output):
+        """Apply the moves queued up for the given visualization.
+        """
+        forward, count = util.PENDING_STEPS.pop(output, (0, 0))
+        if not count or not sublime.View(output).is_valid():
+            return
+
         # `b_view` is the view associated with the actual text buffer we're
         # changing.
         b_view = util.VIS_TO_VIEW[output]
-        if forward:
-            b_view.run_command('sublundo', {'command': 'redo', 'in_vis': True})
-        else:
-            b_view.run_command('sublundo', {'command': 'undo', 'in_vis': True})
-
+        b_view.run_command('sublundo', {
+            'command': 'redo' if forward else 'undo',
+            'in_vis': True,
+            'count': count
+        })
         b_view.run_command('sublundo_visualize', {'output': output})
 
 
@@ -113,6 +142,9 @@ class SublundoSwitchBranchCommand(sublime_plugin.TextCommand):
            3   2                     @   2
         """
         output = sublime.active_window().active_view().id()
+        # Apply any queued moves first, so that we switch branches relative
+        # to the node they lead to.
+        SublundoNextNodeCommand.flush(output)
         b_view = util.VIS_TO_VIEW[output]
         util.VIEW_TO_TREE[b_view.id()]['tree'].switch_branch(forward)
 
@@ -128,7 +160,12 @@ class SublundoVisualizeCommand(sublime_plugin.TextCommand):
         """
         vis = None
         if util.check_view(self.view):
-            # Find our visualization view:
+            # Make sure that a recent (debounced) edit is part of the tree
+            # before we draw it.
+            util.insert_buffer(self.view)
+            t = util.VIEW_TO_TREE[self.view.id()]['tree']
+            # Find our visualization view, re-using an open one if possible:
+            output = output or util.find_visualization(self.view)
             if not output:
                 # We don't have an output view, so it's an initial draw.
                 window = sublime.active_window()
@@ -144,8 +181,9 @@ class SublundoVisualizeCommand(sublime_plugin.TextCommand):
                 vis.settings().set('gutter', False)
                 vis.settings().set('word_wrap', False)
 
-                buf = util.render(util.VIEW_TO_TREE[self.view.id()]['tree'])
+                buf, pos = util.render(t)
                 vis.replace(edit, sublime.Region(0, vis.size()), buf)
+                util.VIS_TO_BUFFER[vis.id()] = buf
 
                 vis.set_syntax_file(
                     'Packages/Sublundo/Sublundo.sublime-syntax')
@@ -166,55 +204,90 @@ class SublundoVisualizeCommand(sublime_plugin.TextCommand):
             else:
                 # We were given an output view, so it's a re-draw.
                 vis = sublime.View(output)
-                buf = util.render(util.VIEW_TO_TREE[self.view.id()]['tree'])
-
-                vis.set_read_only(False)
-                vis.replace(edit, sublime.Region(0, vis.size()), buf)
-                vis.set_read_only(True)
+                buf, pos = util.render(t)
+
+                # Only replace the part of the rendering that has changed
+                # (typically, the old and new active nodes), if anything.
+                shown = util.VIS_TO_BUFFER.get(output)
+                if shown != buf:
+                    region, text = sublime.Region(0, vis.size()), buf
+                    if shown is not None:
+                        region, text = util.changed_region(shown, buf)
+                    vis.set_read_only(False)
+                    vis.replace(edit, region, text)
+                    vis.set_read_only(True)
+                    util.VIS_TO_BUFFER[output] = buf
 
             # Move to the active node.
             sublime.active_window().focus_view(vis)
-            pos = vis.find_by_selector('keyword.other.sublundo.tree.position')
-            if pos:
-                vis.show(pos[0], True)
+            if pos is not None:
+                vis.show(pos, True)
             else:
-                t = util.VIEW_TO_TREE[self.view.id()]['tree']
                 util.debug('No active node? Total size = {0}.'.format(len(t)))
 
 
 class SublundoCommand(sublime_plugin.TextCommand):
     """Sublundo calls a given UndoTree's `undo` or `redo` method.
     """
-    def run(self, edit, command, in_vis=False):
+    def run(self, edit, command, in_vis=False, count=1):
         """Update the current view with the result of calling `undo` or `redo`.
 
         Args:
             command (str): 'undo', 'redo', or 'redo_or_repeat'.
             in_vis (bool): `True` if we were called from `sublundo_next_node`.
+            count (int): The number of times to move in the tree.
         """
-        t = util.VIEW_TO_TREE[self.view.id()]['tree']
-        pos = 0
-        if command == 'undo':
-            buf, diff, pos = t.undo()
-        else:
-            buf, diff, pos = t.redo()
+        info = util.VIEW_TO_TREE[self.view.id()]
+        t = info['tree']
+        # Make sure that any edits still waiting to be inserted are part of
+        # the tree before we move around in it.
+        util.insert_buffer(self.view)
+
+        # The text of the patch is only used by the diff panel, so there's no
+        # need to generate it when the panel isn't showing.
+        window = self.view.window() or sublime.active_window()
+        want_diff = in_vis and window.active_panel() == 'output.sublundo'
+
+        move = t.undo if command == 'undo' else t.redo
+        prev = diff = pos = None
+        for i in range(count):
+            head = t.head()
+            # Only the final step's diff is shown.
+            buf, step, at = move(compute_diff=want_diff and i == count - 1)
+            if t.head() is head:
+                break  # We've reached the root (or a leaf).
+            prev, diff, pos = head, step, at
+
+        if prev is None:
+            # We were already at the root (or a leaf), so the view is up to
+            # date; replacing it would only force a re-highlight.
+            return
+        elif want_diff and diff is None:
+            # We stopped short of `count`, so the last step we actually took
+            # didn't generate its diff.
+            diff = t.diff(prev.idx, t.head().idx)
 
         self.view.replace(edit, sublime.Region(0, self.view.size()), buf)
+        # The view now matches the tree's active state, so there's nothing for
+        # the next `insert_buffer` to pick up.
+        info['changes'] = self.view.change_count()
 
         # Re-position the cursor.
         self.view.sel().clear()
         self.view.sel().add(sublime.Region(pos))
         self.view.show(pos)
 
-        p = sublime.active_window().find_output_panel('sublundo')
-        if all([p, diff, in_vis]):
-            p.replace(edit, sublime.Region(0, p.size()), diff)
+        if in_vis:
+            p = diff and util.diff_panel(window)
+            if p:
+                p.replace(edit, sublime.Region(0, p.size()), diff)
             self.view.add_regions(
                 'sublundo',
                 [self.view.full_line(pos)],
                 'invalid',
                 '',
                 sublime.DRAW_NO_FILL)
+            util.HIGHLIGHTED_VIEWS.add(self.view.id())
 
 
 class UndoEventListener(sublime_plugin.EventListener):
@@ -223,8 +296,11 @@ class UndoEventListener(sublime_plugin.EventListener):
     def on_activated(self, view):
         """Initialize a new UndoTree for the view, if we haven't already.
         """
+        if util.check_view(view):
+            return  # The common case: we're just switching tabs.
+
         name = view.file_name()
-        if name and not util.check_view(view):
+        if name:
             loc = util.make_session(name)
             buf = util.buffer(view)
             t, loaded = util.load_session(loc, buf)
@@ -233,15 +309,26 @@ class UndoEventListener(sublime_plugin.EventListener):
             else:
                 util.debug('Failed to load session for {0}.'.format(name))
                 t.insert(buf, view.sel()[0].a)
-            util.VIEW_TO_TREE[view.id()] = {'tree': t, 'loc': loc}
-            util.CHANGE_INDEX[view.id()] = 0
+            util.VIEW_TO_TREE[view.id()] = {
+                'tree': t,
+                'loc': loc,
+                # `buf` is already in the tree, so there's no need to read
+                # it again until the view changes.
+                'changes': view.change_count()
+            }
 
     def on_close(self, view):
-        """Clean up the visualization.
+        """Forget the view's UndoTree (which `on_pre_close` has saved) and
+        clean up the visualization.
         """
+        util.VIEW_TO_TREE.pop(view.id(), None)
+        util.PENDING_INSERTS.pop(view.id(), None)
         if 'text.sublundo.tree' not in view.scope_name(0):
             return
 
+        util.VIS_TO_VIEW.pop(view.id(), None)
+        util.VIS_TO_BUFFER.pop(view.id(), None)
+
         w = sublime.active_window()
         single = not w.views_in_group(0) or not w.views_in_group(1)
         if w.num_groups() == 2 and single:
@@ -254,21 +341,26 @@ class UndoEventListener(sublime_plugin.EventListener):
             ), 300)
         w.run_command('hide_panel', {'panel': 'output.sublundo'})
         w.destroy_output_panel('output.sublundo')
-        for v in w.views():
-            v.erase_regions('sublundo')
+        for vid in util.HIGHLIGHTED_VIEWS:
+            sublime.View(vid).erase_regions('sublundo')
+        util.HIGHLIGHTED_VIEWS.clear()
 
     def on_pre_close(self, view):
         """Save the current session.
+
+        `save_session` pickles the tree right away (the close may still be
+        cancelled, after which the tree keeps changing) and leaves the disk
+        write to the async thread.
         """
         if util.get_setting('persist') and util.check_view(view):
+            util.insert_buffer(view)
             info = util.VIEW_TO_TREE[view.id()]
             util.save_session(info['tree'], info['loc'])
 
     def on_text_command(self, view, command_name, args):
         """Run `sublundo` instead of the built-in `undo` and `redo` commands.
         """
-        triggers = ('undo', 'redo_or_repeat', 'redo')
-        if util.check_view(view) and command_name in triggers:
+        if command_name in UNDO_COMMANDS and util.check_view(view):
             return ('sublundo', {'command': command_name})
         return None
 
@@ -276,34 +368,52 @@ class UndoEventListener(sublime_plugin.EventListener):
         """Update the tree.
 
         We only update the tree if `view.change_count()` has been incremented
-        since we last checked. TODO: should this be a setting?
+        since we last checked; bursts of edits are coalesced into a single
+        insert (see `insert_debounce_ms`).
         """
-        if command_name != 'sublundo' and view.id() in util.CHANGE_INDEX:
-            if util.CHANGE_INDEX[view.id()] != view.change_count():
-                util.VIEW_TO_TREE[view.id()]['tree'].insert(
-                    util.buffer(view),
-                    view.sel()[0].a
-                )
-                util.CHANGE_INDEX[view.id()] = view.change_count()
+        info = util.VIEW_TO_TREE.get(view.id())
+        if command_name != 'sublundo' and info is not None:
+            if info['changes'] != view.change_count():
+                util.schedule_insert(view)
 
 
 def plugin_loaded():
-    """Ensure that our session storage location exists.
+    """Load our settings and ensure that our session storage location exists.
     """
-    history = os.path.join(sublime.packages_path(), 'User', 'Sublundo')
+    util.watch_settings()
+    history = util.history_dir()
     if not os.path.exists(history):
         os.makedirs(history)
 
 
 def plugin_unloaded():
-    """Clean up *.sublundo-session files.
+    """Save the open views' sessions and clean up stale ones.
+
+    NOTE: Sublime Text doesn't reliably call this on exit, so this only
+    covers reloading (e.g., upgrading) or disabling the package; history that
+    must survive a restart is saved by `on_pre_close`.
     """
+    if util.get_setting('persist'):
+        sessions = []
+        for vid, info in list(util.VIEW_TO_TREE.items()):
+            view = sublime.View(vid)
+            if view.is_valid():
+                util.insert_buffer(view)
+            sessions.append((info['tree'], info['loc']))
+
+        # Our listeners are gone (and `insert_buffer` has cancelled any
+        # pending inserts), so the trees can't change anymore: we can pickle
+        # and write them off of this thread. The async thread may not get to
+        # them while we're being unloaded, so we use our own and only hold up
+        # the unload for a moment.
+        writer = threading.Thread(target=util.write_sessions,
+                                  args=(sessions,))
+        writer.start()
+        writer.join(2.0)
+
     d = util.get_setting('delete_after_n_days', 5)
-    days_ago = datetime.now() - timedelta(days=d)
-    history = os.path.join(sublime.packages_path(), 'User', 'Sublundo')
-    for session in os.listdir(history):
-        if session.endswith('.sublundo-session'):
-            p = os.path.join(history, session)
-            modified = datetime.fromtimestamp(os.path.getmtime(p))
-            if modified > days_ago:
-                os.remove(p)
+    cutoff = time.time() - d * 24 * 60 * 60
+    pattern = os.path.join(util.history_dir(), '*.sublundo-session')
+    for session in glob.iglob(pattern):
+        if os.path.getmtime(session) < cutoff:
+            os.remove(session)
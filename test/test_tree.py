@@ -1,20 +1,14 @@
-import os
+import pickle
 import unittest
 
 from lib.tree import UndoTree
 
 
-def new_tree(name):
-    if os.path.exists(name):
-        os.remove(name)
-    return UndoTree()
-
-
 class UndoTreeTestCase(unittest.TestCase):
     """Tests for navigation and serialization of UndoTree.
     """
     def test_navigate_linear(self):
-        t = new_tree('test.libundo-session')
+        t = UndoTree()
         # Initial state -- one addition ('1'):
         #
         #             1 (@)
@@ -48,7 +42,7 @@ class UndoTreeTestCase(unittest.TestCase):
         self.assertEqual(t.head().idx, 2)
 
     def test_navigate_branch(self):
-        t = new_tree('test.libundo-session')
+        t = UndoTree()
         # Initial state -- one addition ('1'):
         #            1 (@)
         t.insert('My name is Joe.')
@@ -95,7 +89,7 @@ class UndoTreeTestCase(unittest.TestCase):
         self.assertEqual(t.redo()[0], 'My name is Bob.')
 
     def test_switch_branch(self):
-        t = new_tree('test.libundo-session')
+        t = UndoTree()
         self.assertEqual(t.branch(), 0)
 
         #            1
@@ -185,6 +179,64 @@ class UndoTreeTestCase(unittest.TestCase):
         t.redo()
         self.assertEqual(t.head().idx, 5)
 
+    def test_insert_duplicate(self):
+        t = UndoTree()
+        t.insert('My name is Joe.')
+        t.insert('My name is Joe.')
+        self.assertEqual(len(t), 1)
+
+        # A skipped insert shouldn't consume a node ID.
+        t.insert('My name is Bob.')
+        self.assertEqual(len(t), 2)
+        self.assertEqual(t.head().idx, 2)
+        self.assertEqual(t.head().parent.idx, 1)
+
+    def test_navigate_without_diff(self):
+        t = UndoTree()
+        t.insert('My name is Joe.')
+        t.insert('My name is actually Bob.')
+
+        buf, diff, _ = t.undo(compute_diff=False)
+        self.assertEqual(buf, 'My name is Joe.')
+        self.assertIsNone(diff)
+
+        buf, diff, _ = t.redo()
+        self.assertEqual(buf, 'My name is actually Bob.')
+        self.assertIsNotNone(diff)
+        self.assertEqual(t.diff(1, 2), diff)
+
+    def test_navigate_multiple_patches(self):
+        t = UndoTree()
+        before = '\n'.join('Line {0}: My name is Joe.'.format(i)
+                           for i in range(50))
+        # Edit several lines -- some close together, some far apart -- so
+        # that the patch between the two states has multiple parts.
+        after = before.replace('Line 2:', 'L2:').replace('Line 3:', 'L3:')
+        after = after.replace('Line 25:', 'Line twenty-five:')
+        after = after.replace('Line 49: My name is Joe.', 'Bob.')
+
+        t.insert(before)
+        t.insert(after)
+
+        self.assertEqual(t.undo()[0], before)
+        self.assertEqual(t.redo()[0], after)
+        self.assertEqual(t.undo()[0], before)
+
+    def test_serialize(self):
+        t = UndoTree()
+        t.insert('My name is Joe.')
+        t.insert('My name is actually Bob.')
+
+        t = pickle.loads(pickle.dumps(t, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(t.text(), 'My name is actually Bob.')
+        self.assertEqual(t.undo()[0], 'My name is Joe.')
+        self.assertEqual(t.head().idx, 1)
+        self.assertEqual(t.redo()[0], 'My name is actually Bob.')
+
+        t.insert('My name is Bob.')
+        self.assertEqual(t.head().idx, 3)
+        self.assertEqual(t.undo()[0], 'My name is actually Bob.')
+
 
 if __name__ == '__main__':
     unittest.main()